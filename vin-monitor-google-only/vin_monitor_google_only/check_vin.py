@@ -2,18 +2,43 @@
 """
 VIN monitor (Google-only): searches daily for exact VIN matches and alerts only on *new* hits.
 - Uses Google Programmable Search (Custom Search JSON API).
-- Stores seen URLs in state.json to avoid duplicate alerts.
+- Stores seen URLs in state.json (append-only NDJSON, optionally gzipped) to avoid duplicate alerts.
 - Notifies via SMTP email and/or Slack webhook (optional).
 """
+import gzip
+import itertools
 import json
+import logging
 import os
+import smtplib
 import sys
+import threading
 import time
-from urllib.parse import urlparse, parse_qsl, urlunparse, urlencode
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.message import EmailMessage
+from functools import lru_cache
+from urllib.parse import urlparse, urlunparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # optional: faster state (de)serialization
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+log = logging.getLogger(__name__)
+
 # ----- Config -----
 load_dotenv()  # load from .env if present (for local runs)
 
@@ -21,9 +46,13 @@ VIN = os.getenv("VIN")  # REQUIRED (single VIN or comma-separated list)
 GOOGLE_CSE_KEY = os.getenv("GOOGLE_CSE_KEY")  # REQUIRED
 GOOGLE_CSE_ID = os.getenv("GOOGLE_CSE_ID")    # REQUIRED
 
-STATE_PATH = os.getenv("STATE_PATH", "state.json")
+STATE_PATH = os.getenv("STATE_PATH", "state.json")  # gzipped if it ends in .gz
+ETAG_PATH = os.getenv("ETAG_PATH", "etags.json")  # last ETag + results per CSE query
 MAX_RESULTS = int(os.getenv("MAX_RESULTS", "10"))  # Google CSE returns up to 10 per call
+VINS_PER_QUERY = int(os.getenv("VINS_PER_QUERY", "1"))  # >1 OR-s VINs into one CSE query (opt-in, see README)
 USER_AGENT = os.getenv("USER_AGENT", "vin-monitor/1.0 (google-cse)")
+GOOGLE_QPS = float(os.getenv("GOOGLE_QPS", "1.0"))  # sustained CSE requests per second
+GOOGLE_BURST = int(os.getenv("GOOGLE_BURST", "5"))
 
 # Notifications (optional)
 TO_EMAIL = os.getenv("TO_EMAIL")
@@ -33,46 +62,236 @@ SMTP_PORT = int(os.getenv("SMTP_PORT", "587")) if os.getenv("SMTP_PORT") else No
 SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASS = os.getenv("SMTP_PASS")
 SLACK_WEBHOOK_URL = os.getenv("SLACK_WEBHOOK_URL")
+EMAIL_ENABLED = all((TO_EMAIL, FROM_EMAIL, SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASS))
+SLACK_ENABLED = bool(SLACK_WEBHOOK_URL)
+
+# Query-string keys with these prefixes are dropped when normalizing URLs.
+_TRACK = ("utm_", "gclid", "fbclid", "mc_cid", "mc_eid")
+
+# Shared HTTP session: keeps TLS connections alive across per-VIN searches and
+# retries 429/5xx with exponential backoff (honouring Retry-After). These retries
+# happen inside session.get and bypass GOOGLE_LIMITER; the backoff paces them.
+RETRY = Retry(total=5, backoff_factor=1.5, status_forcelist=(429, 500, 502, 503, 504),
+              allowed_methods=frozenset({"GET"}), respect_retry_after_header=True,
+              raise_on_status=False)
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=RETRY))
+SESSION.headers["User-Agent"] = USER_AGENT
 
 # ----- Helpers -----
+if orjson is not None:
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    _loads = orjson.loads
+else:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    _loads = json.loads
+
+def open_state(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, compresslevel=6)
+    return open(path, mode)
+
 def load_state(path: str) -> dict:
+    """Rebuild the seen-sets from the NDJSON log at `path` (one {"vin", "url"} per line).
+
+    `lines` counts records on disk so save_state knows when to compact; None
+    forces a full rewrite on the next save. That happens for a legacy
+    {"seen": {...}} snapshot and for a damaged log, which keeps every record
+    read before the damage. A missing .gz path falls back to the plain file.
+    """
+    state = {"seen": defaultdict(set), "lines": 0}
     if not os.path.exists(path):
-        return {"seen": {}}
+        if path.endswith(".gz") and os.path.exists(path[:-3]):
+            state = load_state(path[:-3])
+            state["lines"] = None
+        return state
+    damaged = False
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        data.setdefault("seen", {})
-        return data
-    except Exception:
-        return {"seen": {}}
+        with open_state(path, "rb") as f:
+            first = f.readline()
+            # A legacy snapshot is one JSON document: indent=2 ("{" alone on the
+            # first line) or compact ({"seen": ...}). Log lines are records.
+            if first.strip() == b"{" or first.startswith(b'{"seen"'):
+                legacy = _loads(first + f.read())
+                for v, urls in legacy.get("seen", {}).items():
+                    state["seen"][v].update(urls)
+                state["lines"] = None
+                return state
+            for line in itertools.chain((first,), f):
+                if not line.strip():
+                    continue
+                try:
+                    rec = _loads(line)
+                    state["seen"][rec["vin"]].add(rec["url"])
+                except (ValueError, KeyError, TypeError):
+                    # Torn or malformed record: keep the rest, rewrite on next save.
+                    damaged = True
+                    continue
+                state["lines"] += 1
+    except (OSError, EOFError, ValueError) as e:
+        # Truncated gzip member or unreadable file: keep what was read so far.
+        log.warning("State file %s is damaged (%s); it will be rewritten.", path, e)
+        damaged = True
+    if damaged:
+        state["lines"] = None
+    return state
+
+def save_state(path: str, state: dict, new_hits: list[tuple[str, str]]) -> None:
+    """Append `new_hits` as (vin, url) records; compact once the log is 2x the unique count."""
+    unique = sum(len(urls) for urls in state["seen"].values())
+    lines = state["lines"]
+    if lines is not None and lines + len(new_hits) <= 2 * unique:
+        with open_state(path, "ab") as f:
+            f.write(b"".join(_dumps({"vin": v, "url": u}) + b"\n" for v, u in new_hits))
+        state["lines"] = lines + len(new_hits)
+        return
+    root, ext = os.path.splitext(path)
+    tmp = root + ".tmp" + ext  # keep the extension so open_state compresses it alike
+    with open_state(tmp, "wb") as f:
+        for v, urls in state["seen"].items():
+            f.write(b"".join(_dumps({"vin": v, "url": u}) + b"\n" for u in sorted(urls)))
+    os.replace(tmp, path)
+    state["lines"] = unique
 
-def save_state(path: str, data: dict) -> None:
-    tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+def load_etags(path: str) -> dict[str, dict]:
+    """Return the {query: {"etag", "items"}} cache at `path`, or {} if missing or unreadable."""
+    try:
+        with open(path, "rb") as f:
+            etags = _loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    return etags if isinstance(etags, dict) else {}
+
+def save_etags(path: str, etags: dict[str, dict]) -> None:
+    root, ext = os.path.splitext(path)
+    tmp = root + ".tmp" + ext
+    with open(tmp, "wb") as f:
+        f.write(_dumps(etags))
     os.replace(tmp, path)
 
+def chunk(items: list, size: int) -> list[list]:
+    size = max(1, size)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def assign_results(group: list[str], results: list[dict]) -> dict[str, list[dict]]:
+    """Split one OR-query's results by which VIN appears in the title, snippet or URL.
+
+    Results that mention none of them (the VIN was only in the page body) go to
+    every VIN in the group rather than being dropped.
+    """
+    out = {v: [] for v in group}
+    for r in results:
+        if len(group) == 1:
+            matched = group
+        else:
+            haystack = " ".join(r.get(k) or "" for k in ("title", "snippet", "url")).upper()
+            matched = [v for v in group if v.upper() in haystack] or group
+        for v in matched:
+            out[v].append(r)
+    return out
+
+@contextmanager
+def state_lock(path: str):
+    """Hold an exclusive advisory lock on `path`.lock so overlapping runs don't lose hits."""
+    with open(path + ".lock", "a+b") as lockf:
+        if fcntl is not None:
+            fcntl.flock(lockf.fileno(), fcntl.LOCK_EX)
+        else:
+            lockf.seek(0)
+            msvcrt.locking(lockf.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockf.fileno(), fcntl.LOCK_UN)
+            else:
+                lockf.seek(0)
+                msvcrt.locking(lockf.fileno(), msvcrt.LK_UNLCK, 1)
+
+class _RateLimiter:
+    """Thread-safe token bucket: `rate` tokens per second, holding at most `burst`."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.min_interval = 1.0 / rate if rate > 0 else 0.0
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last_ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if not self.min_interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_ts) / self.min_interval)
+            self.last_ts = now
+            if self.tokens < 1:
+                wait = (1 - self.tokens) * self.min_interval
+                time.sleep(wait)
+                self.last_ts = time.monotonic()
+                self.tokens = 1.0
+            self.tokens -= 1
+
+GOOGLE_LIMITER = _RateLimiter(GOOGLE_QPS, GOOGLE_BURST)
+
+def _strip_tracking(query: str) -> str:
+    kept = []
+    for p in query.split("&"):
+        if not p:
+            continue
+        k = p.partition("=")[0]
+        if not k.islower():
+            k = k.lower()
+        if not k.startswith(_TRACK):
+            kept.append(p)
+    return "&".join(kept)
+
+@lru_cache(maxsize=4096)
 def normalize_url(u: str) -> str:
+    if not isinstance(u, str):
+        return u
+    # Fast path: nothing for urlparse to strip (query, fragment, params, port,
+    # leading space or tab/newline) and already lowercase.
+    if ("?" not in u and "#" not in u and ";" not in u and u.count(":") == 1
+            and u.islower() and u.isprintable() and not u.startswith(" ")):
+        return u
     try:
         parsed = urlparse(u)
-        qs = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
-              if not k.lower().startswith(("utm_", "gclid", "fbclid", "mc_cid", "mc_eid"))]
-        new_query = urlencode(qs)
-        new_netloc = parsed.netloc.lower().replace(":80", "").replace(":443", "")
-        return urlunparse((parsed.scheme.lower(), new_netloc, parsed.path, parsed.params, new_query, ""))
+        new_query = _strip_tracking(parsed.query)
+        scheme = parsed.scheme if parsed.scheme.islower() else parsed.scheme.lower()
+        nl = parsed.netloc
+        if not nl.islower():
+            nl = nl.lower()
+        if ":" in nl:
+            if nl.endswith(":80"):
+                nl = nl[:-3]
+            elif nl.endswith(":443"):
+                nl = nl[:-4]
+        return urlunparse((scheme, nl, parsed.path, parsed.params, new_query, ""))
     except Exception:
         return u
 
 # ----- Search (Google only) -----
-def search_google_cse_exact(query: str, num: int = 10) -> list[dict]:
+def search_google_cse_exact(query: str, num: int = 10, session: requests.Session = SESSION,
+                            cached: dict | None = None) -> tuple[list[dict], dict | None]:
+    """Return (results, new cache entry). With a `cached` {"etag", "items"} entry the
+    request is conditional; on 304 its items are returned and the entry is None."""
     if not (GOOGLE_CSE_KEY and GOOGLE_CSE_ID):
         raise SystemExit("ERROR: GOOGLE_CSE_KEY and GOOGLE_CSE_ID must be set.")
     url = "https://www.googleapis.com/customsearch/v1"
-    params = {"key": GOOGLE_CSE_KEY, "cx": GOOGLE_CSE_ID, "q": query, "num": min(num, 10)}
-    r = requests.get(url, params=params, timeout=30, headers={"User-Agent": USER_AGENT})
+    params = {"key": GOOGLE_CSE_KEY, "cx": GOOGLE_CSE_ID, "q": query, "num": min(num, 10),
+              # Partial response: only the fields read below, not the full pagemap.
+              "fields": "items(title,link,snippet,pagemap(metatags(article:published_time)))"}
+    headers = {"If-None-Match": cached["etag"]} if cached else None
+    GOOGLE_LIMITER.acquire()
+    r = session.get(url, params=params, headers=headers, timeout=30)
+    if r.status_code == 304:
+        return cached["items"], None
     if r.status_code == 429:
-        print("Rate limited by Google CSE (HTTP 429). Try again later or reduce frequency.", file=sys.stderr)
-        return []
+        log.warning("Rate limited by Google CSE (HTTP 429) after retries. Try again later or lower GOOGLE_QPS.")
+        return [], None
     r.raise_for_status()
     data = r.json()
     items = data.get("items", []) or []
@@ -85,14 +304,13 @@ def search_google_cse_exact(query: str, num: int = 10) -> list[dict]:
             "source": "google_cse",
             "date": it.get("pagemap", {}).get("metatags", [{}])[0].get("article:published_time")
         })
-    return out
+    etag = r.headers.get("ETag")
+    return out, ({"etag": etag, "items": out} if etag else None)
 
 # ----- Notifications -----
 def send_email(subject: str, body: str):
-    if not (TO_EMAIL and FROM_EMAIL and SMTP_SERVER and SMTP_PORT and SMTP_USER and SMTP_PASS):
+    if not EMAIL_ENABLED:
         return
-    import smtplib
-    from email.message import EmailMessage
     msg = EmailMessage()
     msg["From"] = FROM_EMAIL
     msg["To"] = TO_EMAIL
@@ -104,42 +322,78 @@ def send_email(subject: str, body: str):
         s.send_message(msg)
 
 def send_slack(text: str):
-    if not SLACK_WEBHOOK_URL:
+    if not SLACK_ENABLED:
         return
     try:
         requests.post(SLACK_WEBHOOK_URL, json={"text": text}, timeout=15)
     except Exception as e:
-        print("Slack notify failed:", e, file=sys.stderr)
+        log.warning("Slack notify failed: %s", e)
 
 # ----- Main -----
 def main():
+    # Same channels as the old print calls: info to stdout, warnings/errors to stderr.
+    out = logging.StreamHandler(sys.stdout)
+    out.addFilter(lambda record: record.levelno < logging.WARNING)
+    err = logging.StreamHandler(sys.stderr)
+    err.setLevel(logging.WARNING)
+    logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[out, err])
     if not VIN:
-        print("ERROR: Set VIN environment variable.", file=sys.stderr)
+        log.error("ERROR: Set VIN environment variable.")
         sys.exit(2)
 
     vins = [v.strip() for v in VIN.split(",") if v.strip()]
-    queries = [f'\"{v}\"' for v in vins]  # exact phrase
+    if not vins:
+        log.error("ERROR: VIN contains no VINs.")
+        sys.exit(2)
+    # Load, search and save under one lock so a concurrent run (cron + manual)
+    # can't overwrite this run's new hits.
+    with state_lock(STATE_PATH):
+        run(vins)
+
+def run(vins: list[str]) -> None:
+    groups = chunk(vins, VINS_PER_QUERY)
 
     state = load_state(STATE_PATH)
-    any_new = False
+    new_records = []
+    etags = load_etags(ETAG_PATH)
+    # Only queries built from the current VINs are kept, so stale ones drop out.
+    new_etags = {}
 
-    for v, q in zip(vins, queries):
-        print(f"Searching for VIN via Google CSE: {v}")
-        results = search_google_cse_exact(q, num=MAX_RESULTS)
+    # Fetch all VIN groups concurrently; state is only touched on this thread.
+    results_by_vin = {}
+    with ThreadPoolExecutor(max_workers=min(len(groups), 8)) as executor:
+        futures = {}
+        for group in groups:
+            q = " OR ".join(f'\"{v}\"' for v in group)  # exact phrase per VIN
+            log.info("Searching for VIN via Google CSE: %s", ", ".join(group))
+            fut = executor.submit(search_google_cse_exact, q, MAX_RESULTS, cached=etags.get(q))
+            futures[fut] = (q, group)
+        for fut in as_completed(futures):
+            q, group = futures[fut]
+            results, entry = fut.result()
+            entry = entry or etags.get(q)
+            if entry is not None:
+                new_etags[q] = entry
+            results_by_vin.update(assign_results(group, results))
 
-        seen = set(state["seen"].get(v, []))
+    # One digest per run instead of one email/Slack post per VIN.
+    notification_blocks = []
+    for v in vins:
+        results = results_by_vin[v]
+        seen = state["seen"][v]
         new_hits = []
 
         for r in results:
+            if r["url"] in seen:
+                continue
             u_norm = normalize_url(r["url"])
             if u_norm not in seen:
                 new_hits.append((u_norm, r))
 
         if new_hits:
-            any_new = True
             for u_norm, _ in new_hits:
                 seen.add(u_norm)
-            state["seen"][v] = sorted(seen)
+                new_records.append((v, u_norm))
 
             lines = [f"New matches for VIN {v} (found {len(new_hits)}):", ""]
             for u_norm, r in new_hits:
@@ -150,14 +404,20 @@ def main():
                 lines.append(f"- {title}\n  {u_norm}\n  [{source}] {date}\n  {snippet}\n")
             body = "\n".join(lines)
 
-            send_email(subject=f"VIN NEW MATCH: {v}", body=body)
-            send_slack(body)
-            print(body)
+            notification_blocks.append((v, body))
+            log.info(body)
         else:
-            print(f"No NEW matches for {v}. ({len(results)} results scanned)")
+            log.info("No NEW matches for %s. (%d results scanned)", v, len(results))
+
+    if notification_blocks:
+        digest = "\n\n---\n\n".join(body for _, body in notification_blocks)
+        send_email(subject=f"VIN NEW MATCH: {', '.join(v for v, _ in notification_blocks)}", body=digest)
+        send_slack(digest)
 
-    if any_new:
-        save_state(STATE_PATH, state)
+    if new_records:
+        save_state(STATE_PATH, state, new_records)
+    if new_etags != etags:
+        save_etags(ETAG_PATH, new_etags)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,200 @@
+import pytest
+
+import check_vin
+
+
+@pytest.fixture(params=["state.json", "state.json.gz"])
+def state_path(request, tmp_path):
+    return str(tmp_path / request.param)
+
+
+def _save_urls(path, urls):
+    for u in urls:
+        state = check_vin.load_state(path)
+        state["seen"]["VIN1"].add(u)
+        check_vin.save_state(path, state, [("VIN1", u)])
+
+
+def test_roundtrip(state_path):
+    urls = [f"https://example.com/{i}" for i in range(6)]
+    _save_urls(state_path, urls)
+    assert check_vin.load_state(state_path)["seen"]["VIN1"] == set(urls)
+
+
+def test_torn_append_keeps_history_and_is_repaired(state_path):
+    urls = [f"https://example.com/{i}" for i in range(6)]
+    _save_urls(state_path, urls)
+    with open(state_path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 5)
+
+    state = check_vin.load_state(state_path)
+    assert set(urls[:-1]) <= state["seen"]["VIN1"]
+    assert state["lines"] is None  # forces a full rewrite
+
+    state["seen"]["VIN1"].add("https://example.com/new")
+    check_vin.save_state(state_path, state, [("VIN1", "https://example.com/new")])
+    reloaded = check_vin.load_state(state_path)
+    assert reloaded["seen"]["VIN1"] == state["seen"]["VIN1"]
+    assert reloaded["lines"] is not None
+
+
+def test_malformed_records_are_skipped(tmp_path):
+    path = str(tmp_path / "state.json")
+    with open(path, "wb") as f:
+        f.write(b'{"vin":"VIN1","url":"https://a.com/"}\n'
+                b'{"url":"https://no-vin.com/"}\n'
+                b'[1, 2]\n'
+                b'\n'
+                b'{"vin":"VIN1","url":"https://b.com/"}\n')
+    state = check_vin.load_state(path)
+    assert state["seen"]["VIN1"] == {"https://a.com/", "https://b.com/"}
+    assert state["lines"] is None
+
+
+def test_corrupt_gzip_is_rewritten(tmp_path):
+    path = str(tmp_path / "state.json.gz")
+    with open(path, "wb") as f:
+        f.write(b"not gzip at all")
+    state = check_vin.load_state(path)
+    assert not state["seen"]
+    assert state["lines"] is None
+    state["seen"]["VIN1"].add("https://a.com/")
+    check_vin.save_state(path, state, [("VIN1", "https://a.com/")])
+    assert check_vin.load_state(path)["seen"]["VIN1"] == {"https://a.com/"}
+
+
+def test_legacy_snapshot_is_migrated(tmp_path):
+    path = str(tmp_path / "state.json")
+    with open(path, "w") as f:
+        f.write('{\n  "seen": {"VIN1": ["https://a.com/"]}\n}')
+    state = check_vin.load_state(path)
+    assert state["seen"]["VIN1"] == {"https://a.com/"}
+    assert state["lines"] is None
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://example.com", "https://example.com"),
+    ("https://Example.com", "https://example.com"),
+    ("https://EXAMPLE.com/a b", "https://example.com/a b"),
+    ("HTTPS://Ex.COM:443/a?utm_source=x&b=2#frag", "https://ex.com/a?b=2"),
+    ("http://a.com:80/x?Fbclid=1&q", "http://a.com/x?q"),
+    ("https://a.com:8080/x", "https://a.com:8080/x"),
+    ("https://A.com/x;", "https://a.com/x"),
+    ("https://a.com/x;", "https://a.com/x"),
+    (" https://a.com/x\t", "https://a.com/x"),
+])
+def test_normalize_url(url, expected):
+    assert check_vin.normalize_url(url) == expected
+    # The fast path must agree with the full normalization.
+    assert check_vin.normalize_url(expected) == expected
+
+
+def test_normalize_url_passes_through_missing_link():
+    assert check_vin.normalize_url(None) is None
+
+
+class _Response:
+    def __init__(self, status_code, items=None, etag=None):
+        self.status_code = status_code
+        self._items = items
+        self.headers = {"ETag": etag} if etag else {}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"items": self._items}
+
+
+def test_run_uses_etag_cache_and_prunes_stale_queries(tmp_path, monkeypatch):
+    monkeypatch.setattr(check_vin, "STATE_PATH", str(tmp_path / "state.json"))
+    monkeypatch.setattr(check_vin, "ETAG_PATH", str(tmp_path / "etags.json"))
+    monkeypatch.setattr(check_vin, "GOOGLE_CSE_KEY", "key")
+    monkeypatch.setattr(check_vin, "GOOGLE_CSE_ID", "cx")
+    check_vin.save_etags(check_vin.ETAG_PATH, {'"OLDVIN"': {"etag": "old", "items": []}})
+    sent = []
+
+    def fake_get(url, params, headers, timeout):
+        sent.append(headers)
+        if headers:
+            return _Response(304)
+        return _Response(200, [{"title": "VIN1 for sale", "link": "https://a.com/x"}], etag="e1")
+
+    monkeypatch.setattr(check_vin.SESSION, "get", fake_get)
+
+    check_vin.run(["VIN1"])
+    assert check_vin.load_etags(check_vin.ETAG_PATH).keys() == {'"VIN1"'}
+    assert check_vin.load_state(check_vin.STATE_PATH)["seen"]["VIN1"] == {"https://a.com/x"}
+
+    check_vin.run(["VIN1"])
+    assert sent == [None, {"If-None-Match": "e1"}]
+    assert check_vin.load_state(check_vin.STATE_PATH)["lines"] == 1
+
+
+def test_chunk():
+    assert check_vin.chunk(["A", "B", "C"], 2) == [["A", "B"], ["C"]]
+    assert check_vin.chunk(["A", "B"], 0) == [["A"], ["B"]]
+    assert check_vin.chunk([], 8) == []
+
+
+def test_assign_results_splits_by_vin():
+    matched = {"title": "2019 sedan aaa123", "url": "https://a.com/1"}
+    in_url = {"title": "listing", "url": "https://b.com/BBB456"}
+    unmatched = {"title": "no vin here", "snippet": None, "url": "https://c.com/"}
+    out = check_vin.assign_results(["AAA123", "BBB456"], [matched, in_url, unmatched])
+    assert out == {"AAA123": [matched, unmatched], "BBB456": [in_url, unmatched]}
+
+
+def test_assign_results_single_vin_takes_everything():
+    r = {"title": "unrelated", "url": "https://a.com/"}
+    assert check_vin.assign_results(["AAA123"], [r]) == {"AAA123": [r]}
+
+
+class _FakeClock:
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = _FakeClock()
+    monkeypatch.setattr(check_vin.time, "monotonic", fake.monotonic)
+    monkeypatch.setattr(check_vin.time, "sleep", fake.sleep)
+    return fake
+
+
+def test_rate_limiter_allows_burst_then_paces(clock):
+    limiter = check_vin._RateLimiter(rate=2.0, burst=3)
+    for _ in range(3):
+        limiter.acquire()
+    assert clock.sleeps == []
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.sleeps == [pytest.approx(0.5), pytest.approx(0.5)]
+
+
+def test_rate_limiter_refills_while_idle(clock):
+    limiter = check_vin._RateLimiter(rate=1.0, burst=2)
+    limiter.acquire()
+    limiter.acquire()
+    clock.now += 1.0  # one token back
+    limiter.acquire()
+    assert clock.sleeps == []
+    limiter.acquire()
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+
+@pytest.mark.parametrize("rate", [0, -1])
+def test_rate_limiter_disabled_for_non_positive_rate(clock, rate):
+    limiter = check_vin._RateLimiter(rate=rate, burst=1)
+    for _ in range(10):
+        limiter.acquire()
+    assert clock.sleeps == []